@@ -1,11 +1,18 @@
 from pprint import pprint
+import json
 import re
+import shutil
+from functools import cache
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timedelta
+from tempfile import TemporaryDirectory
+from urllib.request import urlopen
 
 import typer
 import polars as pl
+import pyarrow.parquet as pq
 import altair as alt
+import vl_convert as vlc
 from skrub import fuzzy_join, TableReport
 
 MAXJEUNE_DATA_URL = "https://ressources.data.sncf.com/api/explore/v2.1/catalog/datasets/tgvmax/exports/csv"
@@ -17,7 +24,12 @@ MAXJEUNE_DATA_URL = "https://ressources.data.sncf.com/api/explore/v2.1/catalog/d
 STATIONS_DATA_URL = "https://overpass-api.de/api/interpreter?data=%5Bout%3Acsv%28%3A%3Alat%2C%20%3A%3Alon%2C%20name%2C%20%22ref%3AFR%3Asncf%3Aresarail%22%2C%20%22ref%3AFR%3Auic8%22%2C%20%22railway%3Aref%22%3B%20true%3B%20%22%2C%22%29%5D%5Btimeout%3A150%5D%3B%0Anode%5B%22ref%3AFR%3Asncf%3Aresarail%22%5D%3B%0Aout%3B"
 
 DATA_FOLDER = Path("data")
-SCHEMA = {"date": pl.Date, "request_date": pl.Datetime}
+SCHEMA = {
+    "date": pl.Date,
+    "request_date": pl.Datetime,
+    "heure_depart": pl.Time,
+    "heure_arrivee": pl.Time,
+}
 TRAIN = [
     "date",
     "train_no",
@@ -26,67 +38,204 @@ TRAIN = [
     "heure_depart",
     "heure_arrivee",
 ]
+STATIONS = ["origine", "origine_iata", "destination", "destination_iata"]
+PARQUET_OPTIONS = {
+    "compression": "zstd",
+    "compression_level": 3,
+    "statistics": True,
+    "row_group_size": 64_000,
+}
+# Local caches of aggregates over the daily files. They are not committed, so
+# a fresh checkout (such as the daily CI job) starts from an empty cache.
+UNIQUE_STATIONS_FILE = DATA_FOLDER / "_cache" / "unique_stations.pq"
+PER_FILE_STATS_FILE = DATA_FOLDER / "_cache" / "per_file_stats.pq"
+README_STAT_PATTERN = re.compile(r'<span id="(\w+)">[^<]*<\/span>')
+
+# Derived columns, to be added by the queries that need them
+HAS_SEAT = (pl.col("od_happy_card") == "OUI").alias("has_seat")
+DAYS_TO_TRIP = (
+    (pl.col("date") - pl.col("request_date"))
+    .dt.total_days()
+    .cast(pl.Int16)
+    .alias("days_to_trip")
+)
 
 app = typer.Typer()
 
 pl.Config.set_tbl_cols(-1)
 
 
-def scan_files() -> pl.LazyFrame:
-    """Read and parse all Max Jeune CSV files."""
+@cache
+def maxjeune_files() -> list[Path]:
+    """List the Max Jeune files.
 
-    return pl.scan_parquet(
-        DATA_FOLDER / "maxjeune" / "*.pq", include_file_paths="file_path"
-    ).with_columns(
-        has_seat=pl.col("od_happy_card") == "OUI",
-        days_to_trip=(pl.col("date") - pl.col("request_date")).dt.total_days(),
-    )
+    The folder is only listed once per process, call
+    `maxjeune_files.cache_clear()` after adding a file.
+    """
 
+    return sorted((DATA_FOLDER / "maxjeune").glob("*.pq"))
 
-def has_missing_requests():
-    """Find requests that are missing in the downloaded data."""
-    requests = (
-        scan_files()
-        .select("file_path", "request_date")
-        .unique(("file_path", "request_date"))
-        .sort("request_date")
-        .collect(engine="streaming")
+
+def scan_files(files: list[Path] | None = None) -> pl.LazyFrame:
+    """Read all Max Jeune files.
+
+    If `files` is given, only those files are read. Derived columns such as
+    `HAS_SEAT` and `DAYS_TO_TRIP` are left to the callers.
+    """
+
+    if files is None:
+        files = maxjeune_files()
+
+    return pl.scan_parquet(files, include_file_paths="file_path")
+
+
+def _file_request_dates() -> pl.DataFrame:
+    """Read the request date of each Max Jeune file from its parquet footer.
+
+    Each file holds a single request, so the minimum statistic of the
+    `request_date` column is the request date and no data page is read.
+    """
+
+    file_paths, request_dates = [], []
+    for file in maxjeune_files():
+        metadata = pq.read_metadata(file)
+        column = metadata.schema.names.index("request_date")
+
+        file_paths.append(str(file))
+        request_dates.append(metadata.row_group(0).column(column).statistics.min)
+
+    return pl.DataFrame(
+        {"file_path": file_paths, "request_date": request_dates},
+        schema={"file_path": pl.String, "request_date": SCHEMA["request_date"]},
     )
 
-    n_missing_days = (
-        requests.select(diff=pl.col("request_date").dt.date().diff().drop_nulls())
-        .filter(pl.col("diff").dt.total_days() > 1)
-        .count()
-        .item()
+
+def _cached_file_paths(cache_file: Path, file_paths: set[str]) -> set[str]:
+    """Read the paths of the Max Jeune files a cache was computed from.
+
+    The paths are stored in the cache's parquet metadata. No path is
+    returned if the cache is missing or if one of its files is not in
+    `file_paths` anymore, so that the cache is rebuilt.
+    """
+
+    if not cache_file.exists():
+        return set()
+
+    key_values = pq.read_metadata(cache_file).metadata or {}
+    cached_paths = set(json.loads(key_values.get(b"file_paths", b"[]")))
+    if not cached_paths <= file_paths:
+        return set()
+
+    return cached_paths
+
+
+def _write_cache(cache: pl.DataFrame, cache_file: Path, file_paths: set[str]):
+    """Write a cache file along with the paths of the files it covers.
+
+    The cache is written to a temporary file first so that an interrupted
+    write does not leave a broken cache behind.
+    """
+
+    cache_file.parent.mkdir(exist_ok=True, parents=True)
+    tmp_file = cache_file.with_suffix(".tmp")
+    cache.write_parquet(
+        tmp_file, metadata={"file_paths": json.dumps(sorted(file_paths))}
     )
-    n_requested_days = requests.n_unique(pl.col("request_date").dt.date())
-    first_day = requests.select(pl.col("request_date").dt.date().min()).item()
-    last_day = requests.select(pl.col("request_date").dt.date().max()).item()
+    tmp_file.replace(cache_file)
 
-    return {
-        "n_requested_days": n_requested_days,
-        "n_missing_days": n_missing_days,
-        "requests_start": first_day,
-        "requests_end": last_day,
-    }
 
+def scan_unique_stations() -> pl.LazyFrame:
+    """Read the unique origin/destination names and IATA codes.
 
-def plot_n_trains_availability() -> alt.Chart:
-    """Plot the number of available trips in the next 30 days at each request date"""
+    The unique stations are cached along with the paths of the files they
+    were computed from. Only the files missing from the cache are read, and
+    the cache is rebuilt if one of its files was removed.
+    """
 
-    # Create the chart
-    n_available_trips = (
-        scan_files()
-        .group_by("request_date")
-        .agg(
-            disponible=(pl.col("has_seat") == True).sum(),  # noqa: E712
-            total=pl.col("has_seat").len(),
+    file_paths = {str(file) for file in maxjeune_files()}
+    cached_paths = _cached_file_paths(UNIQUE_STATIONS_FILE, file_paths)
+
+    new_paths = file_paths - cached_paths
+    if len(new_paths) > 0:
+        stations = scan_files(sorted(Path(path) for path in new_paths)).select(STATIONS)
+        if len(cached_paths) > 0:
+            stations = pl.concat((pl.scan_parquet(UNIQUE_STATIONS_FILE), stations))
+
+        # Collect before writing since the cache might be one of the sources
+        unique_stations = stations.unique().collect(engine="streaming")
+        _write_cache(unique_stations, UNIQUE_STATIONS_FILE, file_paths)
+
+    return pl.scan_parquet(UNIQUE_STATIONS_FILE)
+
+
+def _per_file_stats() -> pl.DataFrame:
+    """Aggregate the seat availability and trip dates of each Max Jeune file.
+
+    The aggregates are cached in the same way as the unique stations, so
+    only the files that are not in the cache yet are read.
+    """
+
+    file_paths = {str(file) for file in maxjeune_files()}
+    cached_paths = _cached_file_paths(PER_FILE_STATS_FILE, file_paths)
+
+    stats = None
+    if len(cached_paths) > 0:
+        stats = pl.read_parquet(PER_FILE_STATS_FILE)
+
+    new_paths = file_paths - cached_paths
+    if len(new_paths) > 0:
+        new_stats = (
+            scan_files(sorted(Path(path) for path in new_paths))
+            .with_columns(HAS_SEAT)
+            .group_by("file_path")
+            .agg(
+                pl.col("request_date").first(),
+                disponible=pl.col("has_seat").sum(),
+                total=pl.len(),
+                first_date=pl.col("date").min(),
+                last_date=pl.col("date").max(),
+            )
+            .collect(engine="streaming")
         )
-        .collect(engine="streaming")
-        .unpivot(on=["disponible", "total"], index="request_date")
+        stats = new_stats if stats is None else pl.concat((stats, new_stats))
+
+        _write_cache(stats, PER_FILE_STATS_FILE, file_paths)
+
+    return stats
+
+
+def has_missing_requests(requests: pl.LazyFrame | None = None) -> pl.LazyFrame:
+    """Find requests that are missing in the downloaded data.
+
+    `requests` holds the `request_date` of each file. `update_readme` passes
+    the cached per-file statistics. The default, which reads the dates from
+    the parquet footers, is meant for ad-hoc calls. The query returns a
+    single row.
+    """
+
+    if requests is None:
+        requests = _file_request_dates().lazy()
+
+    return requests.select(day=pl.col("request_date").dt.date().sort()).select(
+        n_requested_days=pl.col("day").n_unique(),
+        n_missing_days=(pl.col("day").diff().dt.total_days() > 1).sum(),
+        requests_start=pl.col("day").min(),
+        requests_end=pl.col("day").max(),
     )
 
-    alt.renderers.enable("browser")
+
+def n_trains_availability(file_stats: pl.LazyFrame) -> pl.LazyFrame:
+    """Count the available and total trips in the next 30 days at each request date"""
+
+    return file_stats.group_by("request_date").agg(
+        pl.col("disponible").sum(), pl.col("total").sum()
+    )
+
+
+def plot_n_trains_availability(n_available_trips: pl.DataFrame) -> alt.Chart:
+    """Plot the number of available trips in the next 30 days at each request date"""
+
+    # Create the chart, the series are folded by vega to avoid duplicating the data
     plot = (
         alt.Chart(
             n_available_trips,
@@ -94,6 +243,7 @@ def plot_n_trains_availability() -> alt.Chart:
             height=200,
             title="Historique du nombre de trajets MAXJEUNE et au total, disponibles chaque jour",
         )
+        .transform_fold(["disponible", "total"], as_=["variable", "value"])
         .mark_line()
         .encode(
             x=alt.X(
@@ -101,8 +251,8 @@ def plot_n_trains_availability() -> alt.Chart:
                 title="Date de la recherche",
                 axis=alt.Axis(format="%B %Y"),
             ),
-            y=alt.Y("value", title="Nombre de trajets"),
-            color=alt.Color("variable").legend(title=None),
+            y=alt.Y("value:Q", title="Nombre de trajets"),
+            color=alt.Color("variable:N").legend(title=None),
         )
         .configure_legend(orient="top")
         .configure_axisX(labelAngle=45)
@@ -113,7 +263,7 @@ def plot_n_trains_availability() -> alt.Chart:
 
 @app.command()
 def schema():
-    pprint(scan_files().collect_schema())
+    pprint(scan_files().with_columns(HAS_SEAT, DAYS_TO_TRIP).collect_schema())
 
 
 @app.command()
@@ -133,17 +283,26 @@ def plot_n_days_availability() -> alt.Chart:
         "heure_arrivee",
     ]
 
+    # Trains close to the bounds of the data were not requested for 30 days
+    file_stats = _per_file_stats()
+    first_date = file_stats["first_date"].min()
+    last_date = file_stats["last_date"].max()
+
     n_available_days = (
         scan_files()
+        .with_columns(HAS_SEAT)
+        .filter(
+            pl.col("date").is_between(
+                first_date + timedelta(days=31),
+                last_date - timedelta(days=31),
+                closed="none",
+            )
+        )
         # In case of trains with multiple carriages, we aggregate the disponibility of seats.
         .group_by(*TRAIN)
         .agg(
-            disponible=pl.col("request_date").filter(pl.col("has_seat") == True).sum(),
-            total=pl.col("has_seat").len(),
-        )
-        .filter(
-            pl.col("date") > pl.col("date").min() + pl.duration(days=31),
-            pl.col("date") < pl.col("date").max() - pl.duration(days=31),
+            disponible=pl.col("has_seat").sum(),
+            total=pl.len(),
         )
         .group_by("date")
         .agg(pl.col("disponible").mean(), pl.col("total").mean())
@@ -179,17 +338,32 @@ def plot_n_days_availability() -> alt.Chart:
     return plot
 
 
+def _convert_one(csv_file: Path, pq_file: Path) -> pl.LazyFrame:
+    """Build the query converting and cleaning a scrapy CSV file to parquet."""
+
+    data = pl.scan_csv(csv_file, schema_overrides=SCHEMA)
+    return data.drop("_key", "_type").sink_parquet(
+        pq_file, **PARQUET_OPTIONS, lazy=True
+    )
+
+
 @app.command()
 def convert(from_dir: Path, to_dir: Path):
     """Convert and clean data scraped with scrapy to parquet."""
 
-    for csv_file in from_dir.glob("*.csv"):
-        pq_file = to_dir / (csv_file.stem + ".pq")
-        pl.read_csv(csv_file, schema_overrides=SCHEMA).with_columns(
-            pl.col("heure_depart").str.to_time("%H:%M"),
-            pl.col("heure_arrivee").str.to_time("%H:%M"),
-        ).drop("_key", "_type").write_parquet(pq_file)
-        print(pl.read_parquet(pq_file))
+    files = {
+        csv_file: to_dir / (csv_file.stem + ".pq")
+        for csv_file in from_dir.glob("*.csv")
+    }
+
+    # Files are independent, so polars runs all the conversions at once
+    pl.collect_all(
+        [_convert_one(csv_file, pq_file) for csv_file, pq_file in files.items()],
+        engine="streaming",
+    )
+
+    for pq_file in files.values():
+        print(f"File converted to {pq_file}")
 
 
 @app.command()
@@ -202,22 +376,34 @@ def download_maxjeune():
     maxjeune_folder = DATA_FOLDER / "maxjeune"
     maxjeune_folder.mkdir(exist_ok=True, parents=True)
 
-    file_numbers = sorted(int(file.stem) for file in maxjeune_folder.glob("*.pq"))
-    if len(file_numbers) == 0:
-        next_file = maxjeune_folder / "1.pq"
-    else:
-        next_file = maxjeune_folder / f"{int(file_numbers[-1]) + 1}.pq"
-
-    data = pl.read_csv(
-        MAXJEUNE_DATA_URL, separator=";", schema_overrides=SCHEMA
-    ).with_columns(
-        pl.col("heure_depart").str.to_time("%H:%M"),
-        pl.col("heure_arrivee").str.to_time("%H:%M"),
-        request_date=datetime.now(),
+    last_number = max(
+        (int(file.stem) for file in maxjeune_folder.iterdir() if file.suffix == ".pq"),
+        default=0,
     )
-    data.write_parquet(next_file)
+    next_file = maxjeune_folder / f"{last_number + 1}.pq"
+
+    # Stream the export to disk instead of holding the whole CSV in memory
+    with TemporaryDirectory() as tmp_dir, urlopen(MAXJEUNE_DATA_URL) as response:
+        csv_file = Path(tmp_dir) / "maxjeune.csv"
+        with csv_file.open("wb") as file:
+            shutil.copyfileobj(response, file)
+
+        data = pl.scan_csv(
+            csv_file, separator=";", schema_overrides=SCHEMA
+        ).with_columns(
+            request_date=pl.lit(datetime.now(), dtype=SCHEMA["request_date"])
+        )
+        # Clustering the rows by trip makes the parquet encodings more compact
+        pq_file = Path(tmp_dir) / "maxjeune.pq"
+        data.sort("origine_iata", "destination_iata", "date").sink_parquet(
+            pq_file, **PARQUET_OPTIONS
+        )
+        # Only move the file into the data folder once it is fully written so
+        # that a failed parse does not leave a broken file behind
+        shutil.move(pq_file, next_file)
 
     print(f"File downloaded to {next_file}")
+    maxjeune_files.cache_clear()
 
 
 @app.command()
@@ -243,24 +429,34 @@ def update_readme():
     readme with the total number of request days and missing days
     """
 
-    plot = plot_n_trains_availability()
-    plot.save("assets/n_available_trips.svg")
+    # Both queries only need the cached per-file statistics
+    file_stats = _per_file_stats().lazy()
+    n_available_trips, requests_stats = pl.collect_all(
+        (n_trains_availability(file_stats), has_missing_requests(file_stats)),
+        engine="streaming",
+    )
+
+    plot = plot_n_trains_availability(n_available_trips)
+    Path("assets/n_available_trips.svg").write_text(vlc.vegalite_to_svg(plot.to_dict()))
 
     # Update the readme
     readme_str = Path("README.md").read_text()
 
-    for variable, value in has_missing_requests().items():
-        to_replace = re.search(rf'<span id="{variable}">[^<]*<\/span>', readme_str)[0]
-
+    values = {}
+    for variable, value in requests_stats.row(0, named=True).items():
         if isinstance(value, datetime):
             value = value.strftime("%Y/%m/%d")
-        else:
-            value = str(value)
-
-        # Add the html around it
-        value = f'<span id="{variable}">{value}</span>'
-
-        readme_str = readme_str.replace(to_replace, value)
+        values[variable] = str(value)
+
+    # Replace the content of all the known spans in a single pass
+    readme_str = README_STAT_PATTERN.sub(
+        lambda match: (
+            f'<span id="{match[1]}">{values[match[1]]}</span>'
+            if match[1] in values
+            else match[0]
+        ),
+        readme_str,
+    )
 
     Path("README.md").write_text(readme_str)
 
@@ -273,34 +469,23 @@ def name_changes():
     during the data collection. This detects those.
     """
 
-    origin_name_changes = (
-        scan_files()
-        .group_by("origine", "origine_iata")
-        .agg()
-        .group_by(iata="origine_iata")
-        .agg(names=pl.col("origine").unique())
-        .filter(pl.col("names").list.len() > 1)
-        .collect(engine="streaming")
-    )
-
-    destination_name_changes = (
-        scan_files()
-        .group_by("destination", "destination_iata")
-        .agg()
-        .group_by(iata="destination_iata")
-        .agg(names=pl.col("destination").unique())
-        .filter(pl.col("names").list.len() > 1)
-        .collect(engine="streaming")
-    )
-
     name_changes = (
-        destination_name_changes.join(origin_name_changes, on="iata", how="full")
-        .with_columns(
-            pl.col("names").fill_null(pl.lit([])),
-            pl.col("names_right").fill_null(pl.lit([])),
+        scan_unique_stations()
+        # Stack the origin and destination (iata, name) pairs
+        .select(
+            pairs=pl.concat_list(
+                pl.struct(iata="origine_iata", name="origine"),
+                pl.struct(iata="destination_iata", name="destination"),
+            )
         )
-        .with_columns(names=pl.concat_list("names", "names_right").list.unique())
-        .drop("names_right", "iata_right")
+        .explode("pairs")
+        .unnest("pairs")
+        # Deduplicate the pairs so that the group-by only sees distinct names
+        .unique()
+        .group_by("iata")
+        .agg(names=pl.col("name"))
+        .filter(pl.col("names").list.len() > 1)
+        .collect(engine="streaming")
     )
 
     print("Found", len(name_changes), "name changes")
@@ -316,7 +501,7 @@ def iata_inconsistencies():
     )
     print(stations)
     origins = (
-        scan_files()
+        scan_unique_stations()
         .filter(pl.col("origine") != "TBD")
         .select("origine", iata="origine_iata")
         .unique("iata")
@@ -338,13 +523,13 @@ def iata_inconsistencies():
 
     stations = pl.read_parquet("data/stations.pq").select("iata", "nom")
     origins = (
-        scan_files()
+        scan_unique_stations()
         .select(iata=pl.col("origine_iata").unique())
         .collect(engine="streaming")
     )
 
     destinations = (
-        scan_files()
+        scan_unique_stations()
         .select(iata=pl.col("destination_iata").unique())
         .collect(engine="streaming")
     )
@@ -369,7 +554,7 @@ def iata_inconsistencies():
     )
 
     origins_names = (
-        scan_files()
+        scan_unique_stations()
         .filter(pl.col("origine") != "TBD", pl.col("origine") != "")
         .select("origine", "origine_iata")
         .unique(["origine", "origine_iata"])
@@ -411,8 +596,9 @@ def dev():
     )
     # available_seats = (
     #     scan_files()
+    #     .with_columns(HAS_SEAT)
     #     .group_by("request_date", "origine_iata", "destination_iata")
-    #     .agg(available=pl.col("has_seat").sum(), total=pl.col("has_seat").len())
+    #     .agg(available=pl.col("has_seat").sum(), total=pl.len())
     #     .collect(engine="streaming")
     #     .join(stations, left_on="origine_iata", right_on="iata")
     #     .rename({"lattitude": "origine_lattitude", "longitude": "origine_longitude"})
@@ -422,25 +608,32 @@ def dev():
     #     )
     # )
 
+    unique_stations = scan_unique_stations()
+
     # FIXME: there are stations in the MAXJEUNE data that are not available in
     # the stations data...
-    tgv_origins = stations.join(
-        scan_files()
-        .select(name=pl.col("origine"), iata=pl.col("origine_iata"))
-        .group_by("name", "iata")
+    tgv_names = (
+        pl.concat(
+            (
+                unique_stations.select(
+                    kind=pl.lit("origine"), name="origine", iata="origine_iata"
+                ),
+                unique_stations.select(
+                    kind=pl.lit("destination"),
+                    name="destination",
+                    iata="destination_iata",
+                ),
+            )
+        )
+        .group_by("kind", "name", "iata")
         .agg()
-        .collect(engine="streaming"),
-        on="iata",
-        how="right",
+        .collect(engine="streaming")
+    )
+    tgv_origins = stations.join(
+        tgv_names.filter(kind="origine").drop("kind"), on="iata", how="right"
     )
     tgv_destinations = stations.join(
-        scan_files()
-        .select(name=pl.col("destination"), iata=pl.col("destination_iata"))
-        .group_by("name", "iata")
-        .agg()
-        .collect(engine="streaming"),
-        on="iata",
-        how="right",
+        tgv_names.filter(kind="destination").drop("kind"), on="iata", how="right"
     )
 
     print(
@@ -473,9 +666,10 @@ def dev():
     trips = (
         (
             scan_files()
+            .with_columns(HAS_SEAT)
             .filter(file_path="data/maxjeune/432.pq")
             .group_by("origine_iata", "destination_iata")
-            .agg(available=pl.col("has_seat").sum(), total=pl.col("has_seat").len())
+            .agg(available=pl.col("has_seat").sum(), total=pl.len())
             .collect(engine="streaming")
         )
         .join(